@@ -1,15 +1,67 @@
+import json
+import time
+import random
+import hashlib
+import functools
+import threading
 import aisuite as ai
+import sciris as sc
+import aimigrate as aim
+
+__all__ = ["SimpleQuery", "CachedQuery", "RateLimiter"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """Get the aisuite client shared by all queries, so each provider (and its connections) is only set up once"""
+    return ai.Client()
+
+
+def run_batch(chat, inputs, max_concurrency=5):
+    """Call chat() on each input using up to max_concurrency threads, returning the responses in order"""
+    inputs = list(inputs)
+    if not inputs:
+        return []
+    return sc.parallelize(chat, inputs, ncpus=max_concurrency, parallelizer="thread")
+
+
+def is_transient(error):
+    """Whether an error from an LLM provider is worth retrying (rate limits, server errors, timeouts, dropped connections)"""
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    name = type(error).__name__  # Provider errors, e.g. openai.APITimeoutError
+    return any(key in name for key in ["Timeout", "Connection", "RateLimit", "Overloaded"])
 
-__all__ = ["SimpleQuery"]
 
 class SimpleQuery():
     """
     A simple query interface to interact with an AI model.
+
+    Transient errors (rate limits, server errors, timeouts) are retried up to
+    max_retries times, waiting a random time of up to backoff*2**attempt seconds
+    (capped at one minute) between tries. Other keywords, such as timeout or
+    max_tokens, are passed to the model.
+
+    If stream is True, migrations read the response with stream(), and stop as
+    soon as the code block is complete rather than waiting for any explanation
+    the model writes after it (requires a provider that aisuite can stream from).
+
+    By default, all queries share one aisuite client (and so its connections);
+    to configure the connections, e.g. to use HTTP/2, pass a client instead::
+
+        client = aisuite.Client(provider_configs={"openai": {"http_client": httpx.Client(http2=True)}})
+        chatter = aim.SimpleQuery(model="openai:gpt-4o", client=client)
     """
 
-    def __init__(self, model="openai:gpt-3.5-turbo", **kwargs):
+    def __init__(self, model="openai:gpt-3.5-turbo", max_retries=3, backoff=1.0, stream=False, client=None, **kwargs):
         self.model = model
-        self.client = ai.Client()
+        self.client = client if client is not None else get_client()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stream_responses = stream
         self.kwargs = {'temperature':0.7} | kwargs
         
     def __call__(self, user_input):
@@ -20,9 +72,199 @@ class SimpleQuery():
             {"role": "system", "content": "You are a helpful software engineer."},
             {"role": "user", "content": user_input},
         ]        
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            **self.kwargs
-        )
-        return response.choices[0].message.content
\ No newline at end of file
+        response = self.create(messages)
+        return response.choices[0].message.content
+
+    def create(self, messages, **kwargs):
+        """Send the messages to the model, retrying transient errors"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    **self.kwargs,
+                    **kwargs,
+                )
+            except Exception as E:
+                if attempt == self.max_retries or not is_transient(E):
+                    raise
+                time.sleep(random.uniform(0, min(60, self.backoff * 2**attempt)))  # Full jitter
+
+    def stream(self, user_input):
+        """Query the model, yielding the text of the response as it is generated"""
+        messages = [
+            {"role": "system", "content": "You are a helpful software engineer."},
+            {"role": "user", "content": user_input},
+        ]
+        response = self.create(messages, stream=True)
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:  # Stop generating if the caller stops reading
+            close = getattr(response, "close", None)
+            if close is not None:
+                close()
+
+    def batch(self, inputs, max_concurrency=5):
+        """Query the model with a list of inputs concurrently, returning the responses in order"""
+        return run_batch(self.chat, inputs, max_concurrency=max_concurrency)
+
+
+def read_until_code(deltas):
+    """
+    Join the streamed text of a response, stopping once its code block is complete
+
+    The code is complete once a ```python block closes, or once a block with no
+    language tag closes before any ```python fence has appeared. Blocks in other
+    languages (e.g. a ```diff snippet) don't stop the stream, since the python
+    block that parse_response() prefers may follow.
+    """
+    parts = []
+    for delta in deltas:
+        parts.append(delta)
+        if "`" in delta and has_code_block("".join(parts)):  # Only check when a fence might have arrived
+            break
+    close = getattr(deltas, "close", None)
+    if close is not None:
+        close()
+    return "".join(parts)
+
+
+def has_code_block(text):
+    """Whether the text has a closed ```python block, or (if there is no ```python fence) a closed untagged block"""
+    start = text.find("```python")
+    if start >= 0:
+        return text.find("```", start + 9) >= 0
+    end = -3
+    while True:
+        start = text.find("```", end + 3)
+        if start < 0:
+            return False
+        end = text.find("```", start + 3)
+        if end < 0:
+            return False
+        newline = text.find("\n", start + 3, end)
+        tag = text[start + 3 : end if newline < 0 else newline]
+        if not tag.strip():
+            return True
+
+
+class CachedQuery():
+    """
+    Wrap a query object so that repeated prompts are answered from disk.
+
+    Each response is stored as a JSON file named by the SHA-256 hash of the
+    model, the model keywords, and the prompt, so re-running a migration does
+    not re-query the LLM for prompts it has already answered. If the chatter
+    streams its responses, so does this on a cache miss.
+
+    Args:
+        chatter (SimpleQuery): the query object to wrap
+        cache_dir (str/path): the folder to store responses in (default: ~/.cache/aimigrate/responses)
+
+    **Example**::
+
+        chatter = aim.CachedQuery(aim.SimpleQuery(model='openai:gpt-4o-mini', temperature=0))
+        chatter("What is the state to the North of Oregon?") # Queries the LLM
+        chatter("What is the state to the North of Oregon?") # Loaded from the cache
+    """
+
+    def __init__(self, chatter, cache_dir=None):
+        self.chatter = chatter
+        self.cache_dir = sc.path(sc.ifelse(cache_dir, aim.paths.cache / "responses"))
+
+    def __call__(self, user_input):
+        return self.chat(user_input)
+
+    @property
+    def model(self):
+        return getattr(self.chatter, "model", None)
+
+    @property
+    def stream_responses(self):
+        return getattr(self.chatter, "stream_responses", False)
+
+    def get_key(self, user_input):
+        """Hash the model settings and prompt into the cache key"""
+        settings = dict(model=self.model, kwargs=getattr(self.chatter, "kwargs", None))
+        key = json.dumps(settings, sort_keys=True, default=str) + "\0" + user_input
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def chat(self, user_input):
+        return self.cached(user_input, self.chatter)
+
+    def stream(self, user_input):
+        """Yield the response, streamed from the model (until its code is complete) if it isn't cached yet"""
+        yield self.cached(user_input, lambda text: read_until_code(self.chatter.stream(text)))
+
+    def cached(self, user_input, query):
+        """Load the response from the cache, or get it with query(user_input) and cache it"""
+        path = self.cache_dir / f"{self.get_key(user_input)}.json"
+        if path.exists():
+            try:
+                return sc.loadjson(path)["response"]
+            except (ValueError, KeyError, TypeError):  # A damaged cache file, so query again
+                pass
+        response = query(user_input)
+        aim.utils.savejson_atomic(path, dict(model=self.model, response=response))
+        return response
+
+    def batch(self, inputs, max_concurrency=5):
+        """Query a list of inputs concurrently (using the cache where possible), returning the responses in order"""
+        return run_batch(self.chat, inputs, max_concurrency=max_concurrency)
+
+
+class RateLimiter():
+    """
+    Limit the rate of LLM queries to stay under the provider's rate limits.
+
+    Requests and tokens are each tracked with a bucket that holds up to one
+    minute's allowance and refills continuously; acquire() blocks until both
+    buckets have enough capacity, rather than firing the query and retrying
+    after a rate-limit error. It is thread-safe, so one limiter can be shared by
+    all the threads of a parallel migration.
+
+    Args:
+        rpm (int): the maximum number of requests per minute (default: no limit)
+        tpm (int): the maximum number of (prompt) tokens per minute (default: no limit)
+
+    **Example**::
+
+        limiter = aim.RateLimiter(rpm=500, tpm=30_000)
+        limiter.acquire(n_tokens=1200) # Waits if needed
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm or 0)  # Requests currently available
+        self.tokens = float(tpm or 0)  # Tokens currently available
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n_tokens=0):
+        """Wait until a request with n_tokens tokens can be made, then use up the capacity for it"""
+        if self.tpm:
+            n_tokens = min(n_tokens, self.tpm)  # Otherwise a huge prompt would wait forever
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.updated = now
+                wait = 0
+                if self.rpm:
+                    self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+                    if self.requests < 1:
+                        wait = (1 - self.requests) * 60 / self.rpm
+                if self.tpm:
+                    self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+                    if self.tokens < n_tokens:
+                        wait = max(wait, (n_tokens - self.tokens) * 60 / self.tpm)
+                if not wait:
+                    if self.rpm:
+                        self.requests -= 1
+                    if self.tpm:
+                        self.tokens -= n_tokens
+                    return
+            time.sleep(wait)
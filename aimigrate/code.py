@@ -26,6 +26,7 @@ class ClassVisitor(ast.NodeVisitor):
 
     def __init__(self):
         self.classes = []
+        self.nodes = []  # The ast.ClassDef node for each entry in self.classes
 
     def visit_ClassDef(self, node):
         if isinstance(node, ast.ClassDef):
@@ -45,8 +46,23 @@ class ClassVisitor(ast.NodeVisitor):
                 }
             )
             self.classes.append(class_info)
+            self.nodes.append(node)
         self.generic_visit(node)  # Continue visiting child nodes
 
+    def generic_visit(self, node):
+        """
+        Visit the child statements of a node, skipping expressions
+
+        Classes can only be defined by statements, so this finds the same classes
+        as ast.NodeVisitor.generic_visit() without walking every expression node.
+        """
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                for item in value:
+                    # Statements, plus except handlers and match cases (which have bodies)
+                    if isinstance(item, ast.AST) and not isinstance(item, ast.expr):
+                        self.visit(item)
+
 
 class MethodVisitor(ast.NodeVisitor):
     """
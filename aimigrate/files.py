@@ -3,30 +3,44 @@ Parse the files and folders, including the git diff
 """
 
 import os
+import io
 import ast
 import re
 import fnmatch
-import tiktoken
+import itertools
 import sciris as sc
 import aimigrate as aim
 import subprocess
 
+# Regexes for parsing git diffs
+_FILE_RE = re.compile(r"^diff --git a/(.+?) b/", re.MULTILINE)
+_HUNK_RE = re.compile(r"^@@", re.MULTILINE)
+# Names defined or assigned on changed lines, or in the hunk header's context (the enclosing def/class)
+_CHANGED_NAME_RE = re.compile(
+    r"^(?:[+-]|@@.*?@@)[ \t]*(?:async[ \t]+)?(?:def|class)[ \t]+(\w+)|^[+-][ \t]*(?:self\.)?(\w+)[ \t]*(?::[^=\n]*)?=(?!=)",
+    re.MULTILINE,
+)
 
-def get_python_files(source_dir, gitignore=False, filter=[".py"]):
+
+def get_python_files(source_dir, gitignore=False, filter=[".py"], include=None, exclude=None):
     """
     Recursively retrieves all Python files from the specified directory.
 
     Args:
         source_dir (str): The root directory to search for Python files.
         gitignore (bool, optional): Whether to use the .gitignore file to filter files.
+        include (list of str, optional): fnmatch-style patterns (relative to source_dir); if given, only matching files are kept.
+        exclude (list of str, optional): fnmatch-style patterns (relative to source_dir) of files and folders to skip.
 
     Returns:
         list: A list of file paths to Python files found within the directory.
     """
-    return get_repository_files(source_dir, gitignore=gitignore, filter=filter)
+    return get_repository_files(
+        source_dir, gitignore=gitignore, filter=filter, include=include, exclude=exclude
+    )
 
 
-def get_repository_files(source_dir, gitignore=False, filter=[".py"]):
+def get_repository_files(source_dir, gitignore=False, filter=[".py"], include=None, exclude=None):
     """
     Recursively retrieves all files from the specified directory.
 
@@ -34,39 +48,65 @@ def get_repository_files(source_dir, gitignore=False, filter=[".py"]):
         source_dir (str): The root directory to search for Python files.
         gitignore (bool, optional): Whether to use the .gitignore file to filter files.
         filter (list of str, optional): A list of file suffixes to filter the files
+        include (list of str, optional): fnmatch-style patterns (relative to source_dir); if given,
+            only files matching at least one of them are kept
+        exclude (list of str, optional): fnmatch-style patterns (relative to source_dir) of files and
+            folders to skip; folders are matched with a trailing slash (e.g. "docs/*" skips "docs/")
+            and are not searched at all
 
     Returns:
         list: A list of file paths to files found within the directory.
     """
     if isinstance(source_dir, str):
         source_dir = sc.path(source_dir)
+    suffixes = tuple(filter) if filter is not None else None
+    if suffixes == ():  # Nothing can match
+        return []
+    include_re = _compile_patterns(include)
+    exclude_re = _compile_patterns(exclude)
 
-    python_files = []
     if gitignore:
-        with aim.utils.TemporaryDirectoryChange(source_dir):
-            files = subprocess.check_output("git ls-files", shell=True).splitlines()
-            for file in files:
-                decoded = file.decode()
-                if filter is not None:
-                    for suffix in filter:
-                        if decoded.endswith(suffix):
-                            python_files.append(decoded)
-                            break
-                else:
-                    python_files.append(decoded)
-        python_files = [sc.path(files) for files in python_files]
+        cmd = ["git", "ls-files", "-z"]
+        if suffixes is not None:  # Let git do the suffix filtering
+            cmd += ["--", *(f"*{suffix}" for suffix in suffixes)]
+        files = subprocess.run(
+            cmd, capture_output=True, cwd=source_dir, check=True
+        ).stdout.split(b"\0")
+        python_files = [os.fsdecode(file) for file in files if file]
     else:
-        for root, _, files in os.walk(source_dir):
-            for file in files:
-                if filter is not None:
-                    for suffix in filter:
-                        if file.endswith(suffix):
-                            python_files.append(os.path.join(root, file))
+        python_files = _walk_files(source_dir, exclude_re=exclude_re)
+        if suffixes is not None:
+            python_files = [file for file in python_files if file.endswith(suffixes)]
+
+    if include_re is not None or exclude_re is not None:
+        python_files = [
+            file
+            for file in python_files
+            if (include_re is None or include_re.match(os.path.normcase(file)))
+            and (exclude_re is None or not exclude_re.match(os.path.normcase(file)))
+        ]
+    return [sc.path(file) for file in python_files]
+
+
+def _walk_files(folder, relative="", exclude_re=None):
+    """Recursively yield the paths of all files in a folder (relative to it), like os.walk() but lazily"""
+    subfolders = []
+    try:
+        with os.scandir(os.path.join(folder, relative)) as entries:
+            for entry in entries:
+                path = os.path.join(relative, entry.name)
+                if entry.is_dir():
+                    if entry.is_symlink():  # Like os.walk(), don't follow symlinked folders
+                        continue
+                    elif exclude_re and exclude_re.match(os.path.normcase(path + os.sep)):
+                        continue  # Prune excluded folders before descending into them
+                    subfolders.append(path)
                 else:
-                    python_files.append(os.path.join(root, file))
-
-        python_files = [sc.path(file).relative_to(source_dir) for file in python_files]
-    return python_files
+                    yield path
+    except OSError:
+        return
+    for subfolder in subfolders:
+        yield from _walk_files(folder, subfolder, exclude_re=exclude_re)
 
 
 class GitDiff(sc.prettyobj):
@@ -87,6 +127,8 @@ class GitDiff(sc.prettyobj):
             include_patterns=self.include_patterns,
             exclude_patterns=self.exclude_patterns,
         )
+        self._token_counts = {}  # Token counts of each header/hunk, by model
+        self._file_index = None  # The diffs it was built from, their number, and the diff entries by file
         return
 
     def summarize(self):
@@ -97,11 +139,26 @@ class GitDiff(sc.prettyobj):
         print(f"Names of files found: {[diff['file'] for diff in diffs]}")
         return
 
+    def get_file_diffs(self, file):
+        """
+        Get the diff entries for a file, via an index of the entries by file name
+
+        The index is rebuilt if self.diffs is replaced or changes length.
+        """
+        diffs = self.diffs
+        built = self._file_index
+        if built is None or built[0] is not diffs or built[1] != len(diffs):
+            index = {}
+            for diff in diffs:
+                index.setdefault(diff["file"], []).append(diff)
+            self._file_index = (diffs, len(diffs), index)
+        return self._file_index[2].get(str(file), [])
+
     def get_diff_string(self, file=None):
         """Get the diff string (optionally for a file)"""
         if file is not None:
             return "".join(
-                ["".join(diff["hunks"]) for diff in self.diffs if diff["file"] == file]
+                ["".join(diff["hunks"]) for diff in self.get_file_diffs(file)]
             )
         else:
             return "".join(
@@ -112,22 +169,55 @@ class GitDiff(sc.prettyobj):
             )
 
     def count_all_tokens(self, model="gpt-4o"):
-        """Count the total number of tokens in the diff (all hunks)"""
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-            return len(encoding.encode(self.get_diff_string()))
-        except KeyError:
+        """
+        Count the total number of tokens in the diff (all hunks)
+
+        The count is approximate, since each header and hunk is encoded separately.
+        """
+        if model not in self._token_counts:
+            try:
+                aim.utils.get_encoder(model)
+            except KeyError:
+                self._token_counts[model] = None  # No encoder for this model
+            else:
+                self._token_counts[model] = {}
+        counts = self._token_counts[model]  # Token count of each header/hunk
+        if counts is None:
             return -1
 
+        parts = []
+        for diff in self.diffs:
+            parts.append("\nFile:" + diff["file"] + "\n:")
+            parts.extend(diff["hunks"])
+        missing = [part for part in dict.fromkeys(parts) if part not in counts]
+        if missing:
+            encoding = aim.utils.get_encoder(model)
+            tokens = encoding.encode_ordinary_batch(missing, num_threads=os.cpu_count() or 1)
+            counts.update(zip(missing, map(len, tokens)))
+        return sum(counts[part] for part in parts)
+
+    def get_changed_names(self):
+        """
+        Get the names of the functions, classes and variables changed by the diff
+
+        These are the names defined or assigned on added/removed lines, plus the
+        functions and classes that the changes are inside (from the hunk headers).
+        """
+        names = set()
+        for diff in self.diffs:
+            for hunk in diff["hunks"]:
+                for match in _CHANGED_NAME_RE.finditer(hunk):
+                    names.add(match.group(1) or match.group(2))
+        return names
+
     def print_file_hunks(self, file):
         """
         Print all hunks for a file
         """
-        for diff in self.diffs:
-            if diff.file == file:
-                print(f"All hunks for {file}")
-                for hunk in diff.hunks:
-                    print(f"{hunk}\n")
+        for diff in self.get_file_diffs(file):
+            print(f"All hunks for {file}")
+            for hunk in diff["hunks"]:
+                print(f"{hunk}\n")
         return
 
     @staticmethod
@@ -135,129 +225,232 @@ class GitDiff(sc.prettyobj):
         """
         Parses a git diff file and extracts diffs for specified files, splitting hunks by '@@'.
 
+        A diff string is scanned at once with precompiled regexes for the file
+        headers and hunk starts, and each hunk is sliced out of it (with trailing
+        whitespace removed from each line). An iterable of lines, such as an open
+        file or the stdout pipe of ``git diff``, is parsed one file at a time as it
+        is read, so the full diff never needs to be held in memory.
+
         Args:
-            diff_file_path (str): The path to the diff file.
-            patterns (list of str, optional): A list of patterns to filter the files.
+            file (str/path/iterable): The diff contents, the path to the diff file, or an iterable of diff lines.
+            include_patterns (list of str, optional): Only keep files matching one of these patterns.
+            exclude_patterns (list of str, optional): Skip files matching any of these patterns.
 
         Returns:
             list of dict: A list of dictionaries, each containing the file name and its corresponding diff hunks.
         """
         diffs = []
-        current_file = None
-        current_hunks = []
 
         # If empty string return
         if file == "":
             return diffs
 
-        # In case a filename is provided instead of the file contents
-        if not isinstance(file, str) or "\n" not in file:
+        include_re = _compile_patterns(include_patterns)
+        exclude_re = _compile_patterns(exclude_patterns)
+
+        def keep(current_file):
+            """Skip files that don't match any include pattern or match any exclude pattern"""
+            name = os.path.normcase(current_file)
+            if include_re and not include_re.match(name):
+                return False
+            elif exclude_re and exclude_re.match(name):
+                return False
+            return True
+
+        if isinstance(file, str) and "\n" in file:
+            sections = _split_sections(file, keep)
+        elif isinstance(file, (str, os.PathLike)):
+            # In case a filename is provided instead of the file contents
             with open(file, "r") as f:
-                file = f.readlines()
+                sections = _split_sections(f.read(), keep)
+        else:
+            sections = _iter_sections(file, keep)
+
+        for current_file, section in sections:
+            # Slice the hunks between the '@@' lines of this file's section
+            starts = [m.start() for m in _HUNK_RE.finditer(section)]
+            if not starts:
+                continue
+            bounds = starts + [len(section)]
+            hunks = [
+                _clean_hunk(section[start:stop]) for start, stop in zip(bounds, bounds[1:])
+            ]
+            diffs.append(sc.objdict({"file": current_file, "hunks": hunks}))
+
+        return diffs
+
 
-        for line in file.splitlines():
-            # Match lines that indicate a new file's diff starts
-            file_match = re.match(r"^diff --git a/(.+?) b/", line)
-            hunk_start_match = re.match(r"^@@", line)
+def _split_sections(text, keep):
+    """Split a diff string into (file, section) pairs for the files to keep"""
+    headers = list(_FILE_RE.finditer(text))
+    for i, header in enumerate(headers):
+        current_file = header.group(1)
+        if keep(current_file):
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+            yield current_file, text[header.end() : end]
 
+
+def _iter_sections(lines, keep):
+    """Group an iterable of diff lines into (file, section) pairs for the files to keep, one file at a time"""
+    current_file = None
+    current_lines = []
+    for line in lines:
+        if line.startswith("diff --git "):
+            file_match = _FILE_RE.match(line)
             if file_match:
-                # Save the previous file and hunks if applicable
-                if current_file and current_hunks:
-                    current_hunks.append("".join(current_hunks.pop()))
-                    diffs.append(
-                        sc.objdict({"file": current_file, "hunks": current_hunks})
-                    )
-
-                # Start a new file and check if it matches any pattern
+                if current_file is not None:
+                    yield current_file, "".join(current_lines)
                 current_file = file_match.group(1)
-                if include_patterns and not any(
-                    fnmatch.fnmatch(current_file, pattern)
-                    for pattern in include_patterns
-                ):
-                    # Skip files that don't match any include pattern
-                    current_file = None
-                    current_hunks = []
-                elif exclude_patterns and any(
-                    fnmatch.fnmatch(current_file, pattern)
-                    for pattern in exclude_patterns
-                ):
-                    # Skip files that match any exclude pattern
-                    current_file = None
-                    current_hunks = []
-                else:
-                    current_hunks = []  # Reset hunks for the new file
+                current_file = current_file if keep(current_file) else None
+                current_lines = []
+                continue
+        if current_file is not None:
+            current_lines.append(line if line.endswith("\n") else line + "\n")
+    if current_file is not None:
+        yield current_file, "".join(current_lines)
 
-            elif hunk_start_match:
-                # If there's an ongoing hunk, save it as a new entry before starting a new hunk
-                if current_file and current_hunks and current_hunks[-1]:
-                    current_hunks.append("".join(current_hunks.pop()))
 
-                # Start a new hunk for the current file
-                current_hunks.append([line.rstrip() + "\n"])
+def _compile_patterns(patterns):
+    """Combine fnmatch-style patterns into a single compiled regex (or None)"""
+    if not patterns:
+        return None
+    translated = [fnmatch.translate(os.path.normcase(pattern)) for pattern in patterns]
+    return re.compile("|".join(translated))
 
-            elif current_hunks:
-                # Append line to current hunk if in a hunk
-                current_hunks[-1].append(line.rstrip() + "\n")
 
-        # Save the last file and hunks if present
-        if current_file and current_hunks:
-            current_hunks.append("".join(current_hunks.pop()))
-            diffs.append(sc.objdict({"file": current_file, "hunks": current_hunks}))
-
-        return diffs
+def _clean_hunk(hunk):
+    """Strip trailing whitespace from each line and make sure the hunk ends in a newline"""
+    hunk = "\n".join(map(str.rstrip, hunk.split("\n")))
+    return hunk if hunk.endswith("\n") else hunk + "\n"
 
 
 class PythonCode(sc.prettyobj):
     """
     Parse Python code into classes and methods
+
+    Args:
+        file_path (str/path): the file to read the code from
+        code_str (str): the code itself, if already read (then file_path is not read)
     """
 
-    def __init__(self, file_path: str):
-        self.code_lines = None
+    def __init__(self, file_path: str = None, code_str: str = None):
         self.classes = None
-
-        self.from_file(file_path)
+        self._code_str = None
+        self._code_lines = None
+        self._line_offsets = None
+        self._tree = None
+        self._class_by_name = {}
+        self._class_nodes = {}
+        self._method_cache = {}
+        self._method_spans = {}
+
+        if code_str is None:
+            self.from_file(file_path)
+        else:
+            self._code_str = code_str
         self.set_classes()
         return
 
     def from_file(self, file_path):
         with open(file_path, "r") as file:
-            self.code_lines = file.readlines()
+            self._code_str = file.read()
+        self._code_lines = None
+        self._line_offsets = None
         return
 
+    @property
+    def code_lines(self):
+        """The source split into lines, computed the first time it is needed"""
+        if self._code_lines is None:
+            # Split on "\n" only (like readlines()) so line numbers match the AST
+            self._code_lines = io.StringIO(self._code_str).readlines()
+        return self._code_lines
+
+    @property
+    def line_offsets(self):
+        """Character offset of the start of each line, plus the end of the file"""
+        if self._line_offsets is None:
+            self._line_offsets = [0, *itertools.accumulate(map(len, self.code_lines))]
+        return self._line_offsets
+
     def get_code_string(self):
-        return "".join(self.code_lines)
+        return self._code_str
+
+    def get_lines_string(self, start, stop):
+        """Get the source for lines [start, stop) (0-indexed) as a string without re-joining"""
+        n_lines = len(self.code_lines)
+        start = min(max(start, 0), n_lines)
+        stop = min(max(stop, start), n_lines)
+        offsets = self.line_offsets
+        return self._code_str[offsets[start] : offsets[stop]]
 
     def set_classes(self):
-        tree = ast.parse("".join(self.code_lines))
+        self._tree = ast.parse(self._code_str)
         visitor = aim.ClassVisitor()
-        visitor.visit(tree)
+        visitor.visit(self._tree)
         self.classes = visitor.classes
+        # Index the classes by name (keeping the first if a name is repeated)
+        self._class_by_name = {}
+        self._class_nodes = {}
+        for c, node in zip(visitor.classes, visitor.nodes):
+            if c["name"] not in self._class_by_name:
+                self._class_by_name[c["name"]] = c
+                self._class_nodes[c["name"]] = node
+        self._method_cache = {}
+        self._method_spans = {}
         return
 
+    def get_class(self, name):
+        """Get the information for a class by name"""
+        c = self._class_by_name.get(name)
+        if c is None:
+            raise ValueError(f"Class {name} not found")
+        return c
+
     def get_class_methods(self, name):
         # BUG: how does this work for methods with the same name?
-        for c in self.classes:
-            if c["name"] == name:
-                class_code_list = self.code_lines[c["lineno"] - 1 : c["end_lineno"] + 1]
-                tree = ast.parse("".join(class_code_list))
-                visitor = aim.MethodVisitor()
-                visitor.visit(tree)
-                return class_code_list, visitor
-        raise ValueError(f"Class {name} not found")
+        if name not in self._method_cache:
+            c = self.get_class(name)
+            class_code_list = self.code_lines[c["lineno"] - 1 : c["end_lineno"] + 1]
+            # Reuse the module AST rather than re-parsing the class source
+            visitor = aim.MethodVisitor()
+            visitor.visit(self._class_nodes[name])
+            offset = c["lineno"] - 1  # Line numbers are relative to the class
+            for m in visitor.methods:
+                m["lineno"] -= offset
+                m["end_lineno"] -= offset
+            self._method_cache[name] = (class_code_list, visitor)
+            # Absolute [start, stop) line span of each method, for get_class_string()
+            self._method_spans[name] = {
+                m["name"]: (offset + m["lineno"] - 1, offset + m["end_lineno"] + 1)
+                for m in visitor.methods
+            }
+        return self._method_cache[name]
+
+    def get_names(self):
+        """Get all the names (variables, attributes, imports, and keywords) used in the code"""
+        names = set()
+        for node in ast.walk(self._tree):
+            if isinstance(node, ast.Name):
+                names.add(node.id)
+            elif isinstance(node, ast.Attribute):
+                names.add(node.attr)
+            elif isinstance(node, ast.alias):
+                names.update(node.name.split("."))
+            elif isinstance(node, ast.keyword) and node.arg:
+                names.add(node.arg)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                names.update(node.module.split("."))
+        return names
 
     def get_class_string(self, name, methods_flag=False):
         if methods_flag:
-            code_lines, visitor = self.get_class_methods(name)
-            res = {}
-            for m in visitor.methods:
-                res[m["name"]] = "".join(
-                    code_lines[m["lineno"] - 1 : m["end_lineno"] + 1]
-                )
-            return res
+            self.get_class_methods(name)
+            return {
+                method: self.get_lines_string(start, stop)
+                for method, (start, stop) in self._method_spans[name].items()
+            }
         else:
-            for c in self.classes:
-                if c["name"] == name:
-                    return "".join(
-                        self.code_lines[c["lineno"] - 1 : c["end_lineno"] + 1]
-                    )
+            c = self._class_by_name.get(name)
+            if c is not None:
+                return self.get_lines_string(c["lineno"] - 1, c["end_lineno"] + 1)
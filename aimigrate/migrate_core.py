@@ -1,15 +1,29 @@
 import re
 import types
-import tiktoken
 import sciris as sc
 import aimigrate as aim
 
 __all__ = []
-__all__ = ["CoreMigrate", "CoreCodeFile"]
+__all__ = ["CoreMigrate", "CoreCodeFile", "CoreCodeBatch"]
 
 # TODO: figure out how to expand the context to not need to exclude files
 default_include = ["*.py"]
 default_exclude = ["__init__.py", "setup.py"]
+default_concurrency = 8  # Number of files to query the LLM for at once if parallel=True
+
+# The language tag after an opening code fence, e.g. "py" in "```py\n"
+language_tag_re = re.compile(r"[A-Za-z][\w+.-]*(?=\r?\n)")
+
+# The line starting each file in a batched response, allowing for Markdown emphasis or quoting
+file_marker_re = re.compile(r"^[ \t*_>]*### FILE (\d+)", re.MULTILINE)
+
+# The closing instruction of the default prompts, which batched prompts replace
+single_file_instructions = "Return your updated answer as a single code block embedded between three backticks (```)."
+
+# The closing instruction when several files are migrated in one query
+batch_instructions = """The code above contains {n_files} files, each starting with a "### FILE <number>: <path>" line.
+Update each file separately: for each one, write its "### FILE <number>: <path>" line
+followed by its updated code as a code block embedded between three backticks (```)."""
 
 
 class CoreMigrate(sc.prettyobj):
@@ -27,13 +41,23 @@ class CoreMigrate(sc.prettyobj):
             )
             raise FileNotFoundError(errormsg)
 
-        for file in self.files:
-            source = self.source_dir / file
-            dest = self.dest_dir / file
-            code_file = aim.CoreCodeFile(
-                source=source, dest=dest, file=file
-            )  # Actually do the processing
-            self.code_files.append(code_file)
+        # Reading the files waits on the disk, so overlap it using threads
+        code_files = sc.parallelize(
+            self.make_code_file,
+            self.files,
+            ncpus=min(32, len(self.files)),
+            parallelizer="thread",
+        )
+        self.code_files.extend(code_files)
+
+    def make_code_file(self, file):
+        """Read and parse a single file to migrate"""
+        source = self.source_dir / file
+        dest = self.dest_dir / file
+        code_file = aim.CoreCodeFile(
+            source=source, dest=dest, file=file
+        )  # Actually do the processing
+        return code_file
 
     def log(self, string, color="green"):
         """Print if self.verbose is True"""
@@ -52,11 +76,26 @@ class CoreMigrate(sc.prettyobj):
         """Where everything happens!!"""
         self.log(f"Migrating {code_file.file}")
         try:
-            code_file.run(self.chatter, save=self.save)
+            if self.rate_limiter is not None and not getattr(code_file, "skip", False):
+                n_tokens = code_file.n_tokens
+                if n_tokens is None or n_tokens < 0:  # No encoder, so estimate
+                    n_tokens = len(code_file.prompt) // 4
+                self.rate_limiter.acquire(n_tokens)
+            if isinstance(code_file, aim.CoreCodeBatch):
+                # Files missing from the response are migrated (and any errors handled) one by one
+                code_file.run(self.chatter, save=self.save, run_file=self.run_single)
+            else:
+                code_file.run(self.chatter, save=self.save)
         except Exception as E:
             errormsg = f"Could not parse {code_file.file}: {E}"
+            code_file.error = errormsg
+            for batch_file in getattr(code_file, "code_files", []):  # Every unmigrated file of a batch
+                if batch_file.new_str is None and batch_file.error is None:
+                    batch_file.error = errormsg
             self.errors.append(errormsg)
-            raise E if self.die else print(errormsg)
+            if self.die:
+                raise E
+            print(errormsg)
         return
 
     def run(self):
@@ -69,6 +108,10 @@ class CoreMigrate(sc.prettyobj):
             self.make_encoder()
         if self.chatter is None:
             self.make_chatter()
+        if self.cache and not isinstance(self.chatter, aim.CachedQuery):
+            cache_dir = self.get_cache_dir("responses")
+            self.chatter = aim.CachedQuery(self.chatter, cache_dir=cache_dir)
+        self.make_rate_limiter()
 
         self.log(f"\nStarting migration of {self.source_dir}", color="blue")
         if self.verbose:
@@ -78,30 +121,115 @@ class CoreMigrate(sc.prettyobj):
             f"Length of code_files ({len(self.code_files)}) does not match length of files ({len(self.files)})"
         )
         self.timer = sc.timer()
+        # Files with identical code get identical prompts, so only query for the first of each
+        originals = {}
+        for code_file in self.code_files:
+            originals.setdefault(code_file.orig_str, code_file)
+        code_files = list(originals.values())
+        if self.batch_size > 1:
+            items = self.make_batches(code_files)
+        else:
+            items = code_files
         if self.parallel:
-            sc.parallelize(self.run_single, self.code_files, parallelizer="thread")
+            # Each query spends most of its time waiting on the LLM, so use threads
+            ncpus = default_concurrency if self.parallel is True else int(self.parallel)
+            sc.parallelize(self.run_single, items, ncpus=ncpus, parallelizer="thread")
         else:
-            for code_file in self.code_files:
-                self.run_single(code_file)
+            for item in items:
+                self.run_single(item)
+        for code_file in self.code_files:
+            original = originals[code_file.orig_str]
+            if code_file is not original:
+                code_file.copy_result(original, save=self.save)
+                if code_file.error is not None:  # Report each file that wasn't migrated
+                    self.errors.append(f"Could not parse {code_file.file}: same code as {original.file}, which failed")
         self.timer.toc("Total time")
         return
 
+    def make_file_prompts(self, prompt_kwargs):
+        """
+        Create the prompt for each code file
+
+        Everything but the code is the same for every file, so the template is
+        filled in once and each prompt is joined from the parts around the code.
+        """
+        parts = split_prompt(self.base_prompt, prompt_kwargs)
+        for code_file in self.code_files:
+            code_file.make_prompt(self.base_prompt, prompt_kwargs, parts=parts)
+        return
+
+    def make_batches(self, code_files=None):
+        """Group the code files into batches of up to batch_size files, each migrated with a single query"""
+        code_files = sc.ifelse(code_files, self.code_files)
+        skipped = [code_file for code_file in code_files if code_file.skip]
+        code_files = [code_file for code_file in code_files if not code_file.skip]
+        batches = []
+        for i in range(0, len(code_files), self.batch_size):
+            if i + 1 == len(code_files):  # A single file left over is migrated on its own
+                batches.append(code_files[i])
+                continue
+            batches.append(aim.CoreCodeBatch(code_files[i : i + self.batch_size]))
+        if self.encoder is not None:  # Count the tokens of all the batch prompts at once
+            multi = [batch for batch in batches if isinstance(batch, aim.CoreCodeBatch)]
+            prompts = [batch.prompt for batch in multi]
+            tokens = self.encoder.encode_ordinary_batch(prompts, num_threads=default_concurrency)
+            for batch, batch_tokens in zip(multi, tokens):
+                batch.n_tokens = len(batch_tokens)
+        return batches + skipped
+
     def make_encoder(self):
         self.log("Creating encoder...")
         try:
-            self.encoder = tiktoken.encoding_for_model(
+            self.encoder = aim.utils.get_encoder(
                 self.model
             )  # encoder (for counting tokens)
         except KeyError as E:
             self.log(f"Could not create encoder for {self.model}: {E}", color="yellow")
             self.encoder = None
 
+    def count_tokens(self, batch_size=8):
+        """
+        Count the tokens in each file's prompt (if there is an encoder)
+
+        The count is approximate, since the code and the rest of the prompt are encoded separately.
+        """
+        if self.encoder is None:
+            return
+        shared = {}  # Number of tokens in the prompt without the code, by the prompt parts
+        for i in range(0, len(self.code_files), batch_size):
+            code_files = self.code_files[i : i + batch_size]
+            codes = [code_file.orig_str for code_file in code_files]
+            tokens = self.encoder.encode_ordinary_batch(codes, num_threads=batch_size)
+            for code_file, code_tokens in zip(code_files, tokens):
+                parts = code_file.prompt_parts  # Shared by all files, so cheap to hash
+                if parts is None:
+                    parts = (code_file.base_prompt.format(code="", **code_file.prompt_kwargs),)
+                if parts not in shared:
+                    shared[parts] = len(self.encoder.encode_ordinary("".join(parts)))
+                code_file.n_tokens = shared[parts] + len(code_tokens)
+        return
+
     def make_chatter(self):
         """Create the LLM agent"""
         self.log("Creating agent...")
         self.chatter = aim.SimpleQuery(model=self.model, **self.model_kw)
         return
 
+    def get_cache_dir(self, kind):
+        """Get the folder to cache this kind of result in (e.g. "responses"), or None if caching is off"""
+        if not self.cache:
+            return None
+        root = aim.paths.cache if self.cache is True else sc.path(self.cache)
+        return root / kind
+
+    def make_rate_limiter(self):
+        """Create the rate limiter, if a rate limit is set"""
+        if self.rate_limit is None or isinstance(self.rate_limit, aim.RateLimiter):
+            self.rate_limiter = self.rate_limit
+        else:
+            self.rate_limiter = aim.RateLimiter(**self.rate_limit)
+        return
+
     def parse_library(self):
         """Extract the right folder for library"""
         self.log("Parsing library folder")
@@ -125,12 +253,16 @@ class CoreCodeFile(sc.prettyobj):
         self.file = file
         self.python_code = None
         self.orig_str = None
+        self.base_prompt = None
+        self.prompt_kwargs = None
+        self.prompt_parts = None
         self.prompt = None
         self.chatter = None
         self.n_tokens = None
         self.response = None
         self.new_str = None
         self.error = None
+        self.skip = False  # Whether to keep the code as is, without querying the LLM
         self.timer = None
         self.cost = {"total": 0, "prompt": 0, "completion": 0, "cost": 0}
         if process:
@@ -143,9 +275,20 @@ class CoreCodeFile(sc.prettyobj):
         self.orig_str = self.python_code.get_code_string()
         return
 
-    def make_prompt(self, base_prompt, prompt_kwargs, encoder=None):
-        """Create the prompt for the LLM"""
-        self.prompt = base_prompt.format(code=self.orig_str, **prompt_kwargs)
+    def make_prompt(self, base_prompt, prompt_kwargs, encoder=None, parts=None):
+        """
+        Create the prompt for the LLM
+
+        If parts (the prompt before and after the code, from split_prompt()) is
+        supplied, it is used instead of formatting base_prompt again.
+        """
+        self.base_prompt = base_prompt  # Stored for building batched prompts
+        self.prompt_kwargs = prompt_kwargs
+        self.prompt_parts = parts
+        if parts is not None:
+            self.prompt = "".join((parts[0], self.orig_str, parts[1]))
+        else:
+            self.prompt = base_prompt.format(code=self.orig_str, **prompt_kwargs)
         if encoder is not None:
             self.n_tokens = len(
                 encoder.encode(self.prompt)
@@ -157,33 +300,165 @@ class CoreCodeFile(sc.prettyobj):
     def run_query(self, chatter):
         """Where everything happens!!"""
         with sc.timer(self.file) as self.timer:
-            self.response = chatter(self.prompt)
+            if getattr(chatter, "stream_responses", False):
+                # Stop reading once the code is complete
+                self.response = aim.chat.read_until_code(chatter.stream(self.prompt))
+            else:
+                self.response = chatter(self.prompt)
         return self.response
 
     def parse_response(self):
         """Extract code from the response object"""
         result_string = self.response
-        match_patterns = [r"```python(.*?)```", r"```(.*?)```"]
-        for match_pattern in match_patterns:
-            code_match = re.compile(match_pattern, re.DOTALL).search(result_string)
-            if code_match:
-                break
-        if code_match:
-            self.new_str = code_match.group(1)
+        code = find_code_block(result_string, "```python")
+        if code is None:
+            code = find_code_block(result_string, "```")
+            if code is None and "```" in result_string:  # Truncated, with no closing fence
+                code = result_string[result_string.find("```") + 3 :]
+            if code is not None:  # Drop any other language tag, e.g. ```py or ```Python
+                tag = language_tag_re.match(code)
+                if tag:
+                    code = code[tag.end() :]
+        if code is not None:
+            self.new_str = code
         else:
             self.new_str = result_string
         return
 
     def run(self, chatter, save=True):
         """Run the migration, using the supplied LLM (chatter)"""
+        if self.skip:  # Nothing to migrate, so keep the original code
+            self.new_str = self.orig_str
+            if save:
+                self.save()
+            return self.response
         self.run_query(chatter)
         self.parse_response()
         if save:
             self.save()
         return self.response
 
+    def copy_result(self, other, save=True):
+        """Use the migration of another file with identical code, rather than querying again"""
+        self.response = other.response
+        self.new_str = other.new_str
+        self.error = other.error
+        if save and self.new_str is not None:
+            self.save()
+        return
+
     def save(self):
         """Write to file"""
         sc.makefilepath(self.dest, makedirs=True)
         sc.savetext(self.dest, self.new_str)
         return
+
+
+class CoreCodeBatch(sc.prettyobj):
+    """
+    Several code files migrated with a single query
+
+    The files share the rest of the prompt (e.g. the diff), so sending it once
+    for several files uses fewer requests and input tokens. The code of each
+    file is marked with a "### FILE <number>: <path>" line, and the model is
+    asked to answer in the same format; any file missing from the response is
+    then migrated on its own.
+
+    Args:
+        code_files (list): the CoreCodeFile objects, with their prompts already made
+    """
+
+    def __init__(self, code_files):
+        self.code_files = code_files
+        self.file = ", ".join(str(code_file.file) for code_file in code_files)
+        self.n_tokens = -1
+        self.response = None
+        self.error = None
+        self.timer = None
+        self.make_prompt()
+        return
+
+    def make_prompt(self):
+        """Create a single prompt for all the files, from the first file's prompt template"""
+        first = self.code_files[0]
+        code = "\n".join(
+            f"### FILE {i}: {code_file.file}\n{code_file.orig_str}"
+            for i, code_file in enumerate(self.code_files, 1)
+        )
+        prompt = first.base_prompt.format(code=code, **first.prompt_kwargs)
+        instructions = batch_instructions.format(n_files=len(self.code_files))
+        head, found, tail = prompt.rpartition(single_file_instructions)
+        if found:  # Ask for a block per file instead of a single one
+            self.prompt = head + instructions + tail
+        else:
+            self.prompt = prompt + "\n" + instructions + "\n"
+        return
+
+    def split_response(self):
+        """Split the response into the part for each file, by file number"""
+        markers = list(file_marker_re.finditer(self.response))
+        parts = {}
+        for marker, next_marker in zip(markers, markers[1:] + [None]):
+            stop = next_marker.start() if next_marker else len(self.response)
+            parts.setdefault(int(marker.group(1)), self.response[marker.end() : stop])
+        return parts
+
+    def run(self, chatter, save=True, run_file=None):
+        """
+        Run the migration for all the files, using the supplied LLM (chatter)
+
+        The files found in the response are parsed (and saved) first, then each
+        missing file is migrated on its own by run_file(code_file). By default,
+        this runs it with the chatter, storing any error in its error attribute
+        rather than stopping.
+        """
+        with sc.timer(self.file) as self.timer:
+            self.response = chatter(self.prompt)
+        parts = self.split_response()
+        missing = []
+        for i, code_file in enumerate(self.code_files, 1):
+            part = parts.get(i)
+            if part is not None and find_code_block(part) is not None:
+                code_file.response = part
+                code_file.parse_response()
+                if save:
+                    code_file.save()
+            else:
+                missing.append(code_file)
+        for code_file in missing:
+            if run_file is not None:
+                run_file(code_file)
+                continue
+            try:
+                code_file.run(chatter, save=save)
+            except Exception as E:
+                code_file.error = f"Could not parse {code_file.file}: {E}"
+        return self.response
+
+
+def split_prompt(base_prompt, prompt_kwargs):
+    """
+    Fill in everything but {code} in a prompt template, returning the text before and after the code
+
+    Returns None if the template doesn't use {code} exactly once (e.g. {code!r}).
+    """
+    marker = "\0code\0"
+    parts = base_prompt.format(code=marker, **prompt_kwargs).split(marker)
+    return tuple(parts) if len(parts) == 2 else None
+
+
+def find_code_block(string, fence="```"):
+    """
+    Get the text between the first occurrence of fence and the next "```" (or None)
+
+    Equivalent to re.search(fence + "(.*?)```", string, re.DOTALL).group(1), but
+    using two str.find() calls rather than a regex.
+    """
+    start = string.find(fence)
+    if start < 0:
+        return None
+    start += len(fence)
+    end = string.find("```", start)
+    if end < 0:
+        return None
+    return string[start:end]
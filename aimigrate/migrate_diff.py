@@ -2,7 +2,10 @@
 Migrate using diffs
 """
 
-import fnmatch
+import json
+import hashlib
+import functools
+import subprocess
 import sciris as sc
 import aimigrate as aim
 
@@ -11,6 +14,7 @@ __all__ = ["MigrateDiff"]
 # TODO: figure out how to expand the context to not need to exclude files
 DEFAULT_INCLUDE = ["*.py"]
 DEFAULT_EXCLUDE = ["__init__.py", "setup.py"]
+diff_chunk_size = 500  # Number of files to diff with each git command if diff_speed=True
 
 DEFAULT_BASE_PROMPT = """
 Here is the information for an update to the {library}{library_alias} library captured in a git diff:
@@ -30,6 +34,23 @@ Return your updated answer as a single code block embedded between three backtic
 """
 
 
+@functools.lru_cache(maxsize=16)
+def git_files_diff(library, sha_from, sha_to, files, patience=False):
+    """
+    Get the git diff of some files (a tuple of paths) in the library between two commits
+
+    The files are diffed by a single git command, so git only starts and walks
+    the trees once. The most recent diffs are cached, so migrating several
+    projects against the same library in one session only runs git once. The
+    commits must be SHAs rather than names like "main", which can move.
+    """
+    cmd = ["git", "diff", *(["--patience"] if patience else []), sha_from, sha_to, "--"]
+    cmd += [f":(literal){file}" for file in files]  # Don't treat e.g. "[" in names as wildcards
+    return subprocess.run(
+        cmd, cwd=library, capture_output=True, encoding="utf-8", errors="replace", check=True
+    ).stdout
+
+
 class MigrateDiff(aim.CoreMigrate):
     """
     Handle all steps of code migration
@@ -50,7 +71,11 @@ class MigrateDiff(aim.CoreMigrate):
         base_prompt (str): the prompt template that will be populated with the diff and file information
         diff_speed (bool): whether to use include/exclude to choose files for diff construction. (default False)
         filter (list): if diff_speed=True, a list of file extensions to include when constructing the diff (default [".py"])
-        parallel (bool): whether to migrate the files in parallel
+        parallel (bool/int): whether to migrate the files in parallel; if an int, the maximum number of files to query at once (default 8)
+        rate_limit (dict/RateLimiter): if provided, the requests and/or tokens per minute to stay under, e.g. dict(rpm=500, tpm=30_000)
+        cache (bool/str/path): whether to cache the LLM responses and the parsed library diff on disk, so re-running with identical prompts doesn't re-query the model or re-run git; if a folder, store them there rather than in ~/.cache/aimigrate (default False)
+        skip_unaffected (bool): whether to keep files that don't use any of the names changed in the diff as they are, without querying the LLM (default False)
+        batch_size (int): the number of files to migrate with each query; the rest of the prompt (e.g. the diff) is then sent once per batch rather than once per file (default 1)
         verbose (bool): print information during the migration (default True)
         save (bool): whether to save the files to disk (default True)
         run (bool): whether to perform the migration immediately (default False)
@@ -91,6 +116,10 @@ class MigrateDiff(aim.CoreMigrate):
         model_kw=None,
         base_prompt=None,  # Model settings
         parallel=False,
+        rate_limit=None,
+        cache=False,
+        batch_size=1,
+        skip_unaffected=False,
         verbose=True,
         save=True,
         die=False,
@@ -115,15 +144,21 @@ class MigrateDiff(aim.CoreMigrate):
         self.filter = sc.ifelse(filter, [".py"])
         self.diff_speed = diff_speed
         self.parallel = parallel
+        self.rate_limit = rate_limit
+        self.cache = cache
+        self.batch_size = batch_size
+        self.skip_unaffected = skip_unaffected
         self.verbose = verbose
         self.save = save
         self.die = die
 
         # Populated fields
+        self.git_diff = None
         self.chatter = None
         self.encoder = None
         self.code_files = []
         self.errors = []
+        self.rate_limiter = None
 
         # Optionally run
         if run:
@@ -132,63 +167,131 @@ class MigrateDiff(aim.CoreMigrate):
 
     def make_diff(self):
         self.log("Making the diff")
+        self.git_diff = None
         if self.diff:
             return
         elif self.diff_file:
             with open(self.diff_file, "r") as f:
-                self.diff = f.readlines()
+                self.diff = f.read()  # Parsed as a whole rather than line by line
         else:
             self.parse_library()
+            cwd = self.library
+            # check that the revisions are good, resolving them to commits
+            sha_from = self.resolve_commit(self.v_from)
+            assert sha_from is not None, "Invalid v_from"
+            sha_to = self.resolve_commit(self.v_to)
+            assert sha_to is not None, "Invalid v_to"
             if self.diff_speed:
                 self.diff = ""
-                with aim.utils.TemporaryDirectoryChange(self.library):
-                    # check that the revisions are good
-                    assert not sc.runcommand(
-                        f"git rev-parse --verify {self.v_from}"
-                    ).startswith("fatal"), "Invalid v_from"
-                    assert not sc.runcommand(
-                        f"git rev-parse --verify {self.v_to}"
-                    ).startswith("fatal"), "Invalid v_to"
-                    # get current git commit
-                    current_head = sc.runcommand("git rev-parse HEAD")
-                    # get the files in the library
-                    library_files = aim.files.get_python_files(
-                        self.library, gitignore=True, filter=self.filter
+                # get current git commit
+                current_head = sc.runcommand("git rev-parse HEAD", cwd=cwd)
+                # get the files in the library
+                diff_files = aim.files.get_python_files(
+                    self.library,
+                    gitignore=True,
+                    filter=self.filter,
+                    include=self.include,
+                    exclude=self.exclude,
+                )
+                assert not sc.runcommand(
+                    f"git checkout {current_head}", cwd=cwd
+                ).startswith("error"), "Error checking out previous commit"
+                # get the diff of the files that pass the include/exclude, a chunk at a time
+                # (to keep the command line short enough), running any chunks in threads
+                chunks = [
+                    diff_files[i : i + diff_chunk_size]
+                    for i in range(0, len(diff_files), diff_chunk_size)
+                ]
+                if chunks:
+                    file_diffs = sc.parallelize(
+                        self.files_diff,
+                        chunks,
+                        kwargs=dict(sha_from=sha_from, sha_to=sha_to),
+                        ncpus=min(len(chunks), 8),
+                        parallelizer="thread",
                     )
-                    assert not sc.runcommand(f"git checkout {current_head}").startswith(
-                        "error"
-                    ), "Error checking out previous commit"
-                    # get the diff for each file that passes the include/exclude
-                    for current_file in library_files:
-                        if self.include and not any(
-                            fnmatch.fnmatch(current_file, pattern)
-                            for pattern in self.include
-                        ):
-                            continue
-                        elif self.exclude and any(
-                            fnmatch.fnmatch(current_file, pattern)
-                            for pattern in self.exclude
-                        ):
-                            continue
-                        else:
-                            self.diff += sc.runcommand(
-                                f"git diff {'--patience ' if self.patience else ''}{self.v_from} {self.v_to} -- {current_file}"
-                            )
+                    self.diff = "".join(file_diffs)
             else:
-                with aim.utils.TemporaryDirectoryChange(self.library):
-                    assert not sc.runcommand(
-                        f"git rev-parse --verify {self.v_from}"
-                    ).startswith("fatal"), "Invalid v_from"
-                    assert not sc.runcommand(
-                        f"git rev-parse --verify {self.v_to}"
-                    ).startswith("fatal"), "Invalid v_to"
-                    self.diff = sc.runcommand(f"git diff {self.v_from} {self.v_to}")
+                cache_file = self.get_diff_cache_file(sha_from, sha_to)
+                if cache_file is not None and cache_file.exists():
+                    self.log("Loading the diff from the cache")
+                    self.git_diff = aim.GitDiff(
+                        "", include_patterns=self.include, exclude_patterns=self.exclude
+                    )
+                    self.git_diff.diffs = [sc.objdict(diff) for diff in sc.loadjson(cache_file)]
+                else:
+                    # Parse the diff as git writes it, rather than storing the full diff first
+                    self.git_diff = self.stream_diff(
+                        "--no-color", sha_from, sha_to, "--", *self.get_pathspecs()
+                    )
+                    if cache_file is not None:
+                        aim.utils.savejson_atomic(cache_file, self.git_diff.diffs)
+
+    def resolve_commit(self, version):
+        """Get the SHA of the commit that a version (e.g. a tag or branch) refers to in the library, or None if there isn't one"""
+        result = subprocess.run(
+            ["git", "rev-parse", "--verify", f"{version}^{{commit}}"],
+            cwd=self.library,
+            capture_output=True,
+            text=True,
+        )
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    def get_diff_cache_file(self, sha_from, sha_to):
+        """
+        Get the file to cache the parsed diff in (or None if caching is off)
+
+        The diff only depends on the commits (not the names they were given by,
+        which can move) and the include/exclude patterns, so those make the key,
+        along with the aimigrate version in case the way diffs are parsed changes.
+        The parsed diff entries are stored as JSON.
+        """
+        cache_dir = self.get_cache_dir("diffs")
+        if cache_dir is None:
+            return None
+        settings = [sha_from, sha_to, self.include, self.exclude, aim.__version__]
+        key = hashlib.sha256(json.dumps(settings, default=str).encode()).hexdigest()
+        return cache_dir / f"{key}.json"
+
+    def files_diff(self, files, sha_from, sha_to):
+        """Get the diff between two commits (v_from and v_to) for a list of files in the library"""
+        return git_files_diff(
+            str(self.library),
+            sha_from,
+            sha_to,
+            tuple(str(file) for file in files),
+            bool(self.patience),
+        )
+
+    def get_pathspecs(self):
+        """Translate include/exclude into git pathspecs (from the top of the repo), so git skips the excluded files"""
+        pathspecs = [f":(top){pattern}" for pattern in self.include or []]
+        for pattern in self.exclude or []:
+            if any(char in pattern for char in "*?["):  # Otherwise git would also exclude folders of that name
+                pathspecs.append(f":(top,exclude){pattern}")
+        if pathspecs and not self.include:
+            pathspecs.insert(0, ":(top)")  # Exclusions need something to exclude from
+        return pathspecs
+
+    def stream_diff(self, *args):
+        """Run git diff on the library and parse its output as it is produced"""
+        cmd = ["git", "diff", *args]
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, cwd=self.library, encoding="utf-8", errors="replace"
+        ) as proc:
+            git_diff = aim.GitDiff(
+                proc.stdout, include_patterns=self.include, exclude_patterns=self.exclude
+            )
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return git_diff
 
     def parse_diff(self):
         self.log("Parsing the diff")
-        self.git_diff = aim.GitDiff(
-            self.diff, include_patterns=self.include, exclude_patterns=self.exclude
-        )
+        if self.git_diff is None:  # Not already parsed while streaming
+            self.git_diff = aim.GitDiff(
+                self.diff, include_patterns=self.include, exclude_patterns=self.exclude
+            )
         self.git_diff.summarize()  # summarize
         self.n_tokens = self.git_diff.count_all_tokens(
             model=self.model
@@ -197,19 +300,33 @@ class MigrateDiff(aim.CoreMigrate):
             print(f"Number of tokens in the diff: {self.n_tokens}")
 
     def make_prompts(self):
+        if self.encoder is None:  # Needed to count the tokens of each prompt
+            self.make_encoder()
         diff_string = self.git_diff.get_diff_string()
+        self.make_file_prompts(
+            prompt_kwargs={
+                "library": self.library.stem,
+                "library_alias": f" ({self.library_alias})"
+                if self.library_alias
+                else "",
+                "diff": diff_string,
+            },
+        )
+        self.count_tokens()
+        return
+
+    def skip_files(self):
+        """
+        Mark the files that don't use any name changed in the diff, so they are kept as is
+
+        This is a heuristic: it only checks whether a file mentions a function,
+        class, or variable that the diff defines, assigns, or changes inside of.
+        """
+        changed_names = self.git_diff.get_changed_names()
         for code_file in self.code_files:
-            code_file.make_prompt(
-                self.base_prompt,
-                prompt_kwargs={
-                    "library": self.library.stem,
-                    "library_alias": f" ({self.library_alias})"
-                    if self.library_alias
-                    else "",
-                    "diff": diff_string,
-                },
-                encoder=self.encoder,
-            )
+            if not changed_names & code_file.python_code.get_names():
+                code_file.skip = True
+                self.log(f"Skipping {code_file.file}, which the diff doesn't affect")
         return
 
     def run(self):
@@ -219,6 +336,9 @@ class MigrateDiff(aim.CoreMigrate):
         self.parse_diff()
         # parse the files for migration
         self.make_code_files()
+        # skip the files the diff doesn't affect
+        if self.skip_unaffected:
+            self.skip_files()
         # make the prompts
         self.make_prompts()
         # run
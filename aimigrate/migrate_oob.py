@@ -36,7 +36,10 @@ class MigrateOOB(aim.CoreMigrate):
         model (str): the LLM to use
         model_kw (dict): any keywords to pass to the model
         base_prompt (str): the prompt template that will be populated with the diff and file information
-        parallel (bool): whether to migrate the files in parallel
+        parallel (bool/int): whether to migrate the files in parallel; if an int, the maximum number of files to query at once (default 8)
+        rate_limit (dict/RateLimiter): if provided, the requests and/or tokens per minute to stay under, e.g. dict(rpm=500, tpm=30_000)
+        cache (bool/str/path): whether to cache the LLM responses on disk, so re-running with identical prompts doesn't re-query the model; if a folder, store them there rather than in ~/.cache/aimigrate (default False)
+        batch_size (int): the number of files to migrate with each query; the rest of the prompt (e.g. the diff) is then sent once per batch rather than once per file (default 1)
         verbose (bool): print information during the migration (default True)
         save (bool): whether to save the files to disk (default True)
         run (bool): whether to perform the migration immediately (default False)
@@ -70,6 +73,9 @@ class MigrateOOB(aim.CoreMigrate):
         model_kw=None,
         base_prompt=None,  # Model settings
         parallel=False,
+        rate_limit=None,
+        cache=False,
+        batch_size=1,
         verbose=True,
         save=True,
         die=False,
@@ -87,6 +93,9 @@ class MigrateOOB(aim.CoreMigrate):
         self.model_kw = sc.mergedicts(model_kw)
         self.base_prompt = sc.ifelse(base_prompt, DEFAULT_BASE_PROMPT)
         self.parallel = parallel
+        self.rate_limit = rate_limit
+        self.cache = cache
+        self.batch_size = batch_size
         self.verbose = verbose
         self.save = save
         self.die = die
@@ -96,6 +105,7 @@ class MigrateOOB(aim.CoreMigrate):
         self.encoder = None
         self.code_files = []
         self.errors = []
+        self.rate_limiter = None
 
         assert isinstance(self.library, (str, types.ModuleType)), (
             "Library must be a string or module"
@@ -108,21 +118,19 @@ class MigrateOOB(aim.CoreMigrate):
 
     def make_prompts(self):
         self.make_encoder()
-        for code_file in self.code_files:
-            code_file.make_prompt(
-                self.base_prompt,
-                prompt_kwargs={
-                    "library": self.library.__name__
-                    if hasattr(self.library, "__name__")
-                    else self.library,
-                    "library_alias": f" ({self.library_alias})"
-                    if self.library_alias
-                    else "",
-                    "v_from": self.v_from,
-                    "v_to": self.v_to,
-                },
-                encoder=self.encoder,
-            )
+        self.make_file_prompts(
+            prompt_kwargs={
+                "library": self.library.__name__
+                if hasattr(self.library, "__name__")
+                else self.library,
+                "library_alias": f" ({self.library_alias})"
+                if self.library_alias
+                else "",
+                "v_from": self.v_from,
+                "v_to": self.v_to,
+            },
+        )
+        self.count_tokens()
 
     def run(self):
         # parse the files for migration
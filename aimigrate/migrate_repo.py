@@ -2,7 +2,6 @@
 Migrate using the code in the target libarary as context.
 """
 
-import fnmatch
 import sciris as sc
 import aimigrate as aim
 
@@ -47,7 +46,10 @@ class MigrateRepo(aim.CoreMigrate):
         include (list): the list of files to include from the diff
         exclude (list): the list of files to not include from the diff
         base_prompt (str): the prompt template that will be populated with the diff and file information
-        parallel (bool): whether to migrate the files in parallel
+        parallel (bool/int): whether to migrate the files in parallel; if an int, the maximum number of files to query at once (default 8)
+        rate_limit (dict/RateLimiter): if provided, the requests and/or tokens per minute to stay under, e.g. dict(rpm=500, tpm=30_000)
+        cache (bool/str/path): whether to cache the LLM responses on disk, so re-running with identical prompts doesn't re-query the model; if a folder, store them there rather than in ~/.cache/aimigrate (default False)
+        batch_size (int): the number of files to migrate with each query; the rest of the prompt (e.g. the diff) is then sent once per batch rather than once per file (default 1)
         verbose (bool): print information during the migration (default True)
         save (bool): whether to save the files to disk (default True)
         run (bool): whether to perform the migration immediately (default False)
@@ -84,6 +86,9 @@ class MigrateRepo(aim.CoreMigrate):
         model_kw=None,
         base_prompt=None,  # Model settings
         parallel=False,
+        rate_limit=None,
+        cache=False,
+        batch_size=1,
         verbose=True,
         save=True,
         die=False,
@@ -104,6 +109,9 @@ class MigrateRepo(aim.CoreMigrate):
         self.base_prompt = sc.ifelse(base_prompt, DEFAULT_BASE_PROMPT)
         self.filter = sc.ifelse(filter, [".py"])
         self.parallel = parallel
+        self.rate_limit = rate_limit
+        self.cache = cache
+        self.batch_size = batch_size
         self.verbose = verbose
         self.save = save
         self.die = die
@@ -113,6 +121,7 @@ class MigrateRepo(aim.CoreMigrate):
         self.encoder = None
         self.code_files = []
         self.errors = []
+        self.rate_limiter = None
 
         # Optionally run
         if run:
@@ -136,29 +145,23 @@ class MigrateRepo(aim.CoreMigrate):
         self.log("Getting the repository files")
         self.parse_library()
         self.repo_files = []
-        with aim.utils.TemporaryDirectoryChange(self.library):
-            # get current git commit
-            current_head = sc.runcommand("git rev-parse HEAD")
-            assert not sc.runcommand(f"git checkout {self.v_to}").startswith("error"), (
-                "Invalid v_to"
-            )
-            all_repo_files = aim.files.get_python_files(
-                self.library, gitignore=True, filter=self.filter
-            )
-            assert not sc.runcommand(f"git checkout {current_head}").startswith(
-                "error"
-            ), "Error checking out previous commit"
-        for current_file in all_repo_files:
-            if self.include and not any(
-                fnmatch.fnmatch(current_file, pattern) for pattern in self.include
-            ):
-                continue
-            elif self.exclude and any(
-                fnmatch.fnmatch(current_file, pattern) for pattern in self.exclude
-            ):
-                continue
-            else:
-                self.repo_files.append(current_file)
+        cwd = self.library
+        # get current git commit
+        current_head = sc.runcommand("git rev-parse HEAD", cwd=cwd)
+        assert not sc.runcommand(f"git checkout {self.v_to}", cwd=cwd).startswith(
+            "error"
+        ), "Invalid v_to"
+        all_repo_files = aim.files.get_python_files(
+            self.library,
+            gitignore=True,
+            filter=self.filter,
+            include=self.include,
+            exclude=self.exclude,
+        )
+        assert not sc.runcommand(f"git checkout {current_head}", cwd=cwd).startswith(
+            "error"
+        ), "Error checking out previous commit"
+        self.repo_files.extend(all_repo_files)
 
     def parse_repo_files(self):
         self.log("Parsing repository files")
@@ -177,16 +180,14 @@ class MigrateRepo(aim.CoreMigrate):
         return
 
     def make_prompts(self):
-        for code_file in self.code_files:
-            code_file.make_prompt(
-                self.base_prompt,
-                prompt_kwargs={
-                    "library": self.library.stem,
-                    "library_alias": f" ({self.library_alias})"
-                    if self.library_alias
-                    else "",
-                    "library_code": self.repo_string,
-                },
-                encoder=self.encoder,
-            )
+        self.make_file_prompts(
+            prompt_kwargs={
+                "library": self.library.stem,
+                "library_alias": f" ({self.library_alias})"
+                if self.library_alias
+                else "",
+                "library_code": self.repo_string,
+            },
+        )
+        self.count_tokens()
         return
@@ -12,3 +12,6 @@ src = root
 
 # Data directory
 data = src / "data"
+
+# Cache directory (e.g., for LLM responses)
+cache = Path.home() / ".cache" / "aimigrate"
@@ -1,5 +1,10 @@
 import os
+import json
+import tempfile
+import warnings
+import functools
 import importlib.util
+import tiktoken
 
 
 # Using a context manager to temporarily change the directory
@@ -14,9 +19,14 @@ class TemporaryDirectoryChange:
         pass
     ```
 
+    Deprecated: the working directory is shared by the whole process, so this
+    is not thread-safe; to run a command in another folder, pass ``cwd`` to
+    ``sc.runcommand()`` or ``subprocess`` instead.
+
     Attributes:
         new_dir (str): The directory to change to.
         original_dir (str): The original directory before the change.
+        changed (bool): Whether the directory was actually changed (False if already in `new_dir`).
 
     Methods:
         __enter__(): Changes the current working directory to `new_dir`.
@@ -24,14 +34,24 @@ class TemporaryDirectoryChange:
     """
 
     def __init__(self, new_dir):
+        warnings.warn(
+            "TemporaryDirectoryChange is deprecated since it is not thread-safe; pass cwd to the command instead",
+            DeprecationWarning,
+            stacklevel=2,
+        )
         self.new_dir = new_dir
         self.original_dir = os.getcwd()
+        self.changed = False
 
     def __enter__(self):
-        os.chdir(self.new_dir)
+        self.original_dir = os.getcwd()
+        self.changed = os.path.realpath(self.new_dir) != os.path.realpath(self.original_dir)
+        if self.changed:
+            os.chdir(self.new_dir)
 
     def __exit__(self, exc_type, exc_value, traceback):
-        os.chdir(self.original_dir)
+        if self.changed:
+            os.chdir(self.original_dir)
 
 
 class EmptyCallback:
@@ -53,6 +73,34 @@ class EmptyCallback:
         pass
 
 
+@functools.lru_cache(maxsize=8)
+def get_encoder(model):
+    """
+    Get the tiktoken encoder for a model, reusing it across calls.
+
+    Raises a KeyError if tiktoken does not know the model.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
+def savejson_atomic(filename, obj):
+    """
+    Save an object as JSON via a temporary file in the same folder, so the file
+    is replaced in one step and an interrupted save never leaves it half-written.
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(obj, f)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return
+
+
 def get_module_name():
     current_dir = os.path.abspath(os.getcwd())
     parent_dir = os.path.dirname(current_dir)
@@ -1,6 +1,88 @@
+import pytest
+import sciris as sc
 import aimigrate as aim
 
 def test_SimpleQuery():
     chatter = aim.SimpleQuery(model='openai:gpt-4o-mini')
     response = chatter("Hi, I'm in Oregon. What is the state to the North of me?")
     assert isinstance(response, str)
+
+def test_CachedQuery(tmp_path):
+    calls = []
+    def chatter(user_input):
+        calls.append(user_input)
+        return user_input.upper()
+    cached = aim.CachedQuery(chatter, cache_dir=tmp_path)
+    assert cached("hello") == "HELLO"
+    assert cached("hello") == "HELLO"
+    assert cached("world") == "WORLD"
+    assert calls == ["hello", "world"]
+    assert cached.batch(["world", "again", "hello"]) == ["WORLD", "AGAIN", "HELLO"]
+    assert calls == ["hello", "world", "again"]
+    sc.savetext(tmp_path / f'{cached.get_key("hello")}.json', '{"model": null, "resp') # Interrupted write
+    assert cached("hello") == "HELLO" # Queried again
+    assert cached("hello") == "HELLO" # And the cache repaired
+    assert calls == ["hello", "world", "again", "hello"]
+
+def test_RateLimiter():
+    limiter = aim.RateLimiter(tpm=6000) # 100 tokens per second
+    with sc.timer() as T1:
+        limiter.acquire(6000) # The bucket starts full
+    with sc.timer() as T2:
+        limiter.acquire(20) # Has to wait for it to refill
+    assert T1.elapsed < 0.1
+    assert 0.1 < T2.elapsed < 1
+
+def test_SimpleQuery_retries():
+    class RateLimitError(Exception):
+        status_code = 429
+    class Completions:
+        calls = 0
+        def create(self, **kwargs):
+            self.calls += 1
+            if self.calls < 3:
+                raise RateLimitError('Slow down')
+            message = sc.objdict(content='Washington')
+            return sc.objdict(choices=[sc.objdict(message=message)])
+    chatter = aim.SimpleQuery(model='openai:gpt-4o-mini', backoff=0)
+    chatter.client = sc.objdict(chat=sc.objdict(completions=Completions()))
+    assert chatter("What is the state to the North of Oregon?") == 'Washington'
+    assert chatter.client.chat.completions.calls == 3
+
+    chatter.max_retries = 1 # Gives up after the second failure
+    chatter.client.chat.completions.calls = 0
+    with pytest.raises(RateLimitError):
+        chatter("What is the state to the North of Oregon?")
+
+def test_SimpleQuery_stream(tmp_path):
+    pieces = ['Here you go:\n``', '`python\nx = 1\n', '``', '`\n', 'This code sets x to 1.', ' It is very good code.']
+    read = []
+    class Completions:
+        def create(self, stream=False, **kwargs):
+            assert stream
+            for piece in pieces:
+                read.append(piece)
+                yield sc.objdict(choices=[sc.objdict(delta=sc.objdict(content=piece))])
+    chatter = aim.SimpleQuery(model='openai:gpt-4o-mini', stream=True)
+    chatter.client = sc.objdict(chat=sc.objdict(completions=Completions()))
+    code_file = aim.CoreCodeFile(source=None, dest=None, file='a.py', process=False)
+    code_file.prompt = 'Set x to 1'
+    code_file.run(chatter, save=False)
+    assert code_file.new_str == '\nx = 1\n'
+    assert read == pieces[:4] # Stopped reading after the closing fence
+
+    # A snippet in another language first doesn't stop the stream before the python block
+    pieces = ['Change:\n```diff\n-x = 0\n+x = 1\n```\n', 'Code:\n```python\nx = 1\n', '```\n', 'Done.']
+    read.clear()
+    code_file.run(chatter, save=False)
+    assert code_file.new_str == '\nx = 1\n'
+    assert read == pieces[:3]
+
+    # Streaming still works with the responses cached
+    cached = aim.CachedQuery(chatter, cache_dir=tmp_path)
+    for i in range(2):
+        read.clear()
+        code_file.new_str = None
+        code_file.run(cached, save=False)
+        assert code_file.new_str == '\nx = 1\n'
+        assert read == (pieces[:3] if i == 0 else []) # Only streamed from the model the first time
@@ -0,0 +1,113 @@
+import pytest
+import aimigrate as aim
+
+code = '''import os
+
+class A:
+    def one(self):
+        return 1
+
+    def two(self):
+        return 2
+
+class B(A):
+    def three(self):
+        return 3
+'''
+
+def test_PythonCode(tmp_path):
+    path = tmp_path / 'code.py'
+    path.write_text(code)
+    python_code = aim.PythonCode(path)
+    assert python_code.get_code_string() == code
+    assert [c['name'] for c in python_code.classes] == ['A', 'B']
+    assert python_code.get_class_string('B').startswith('class B(A):')
+    methods = python_code.get_class_string('A', methods_flag=True)
+    assert list(methods) == ['one', 'two']
+    assert 'return 2' in methods['two']
+    with pytest.raises(ValueError):
+        python_code.get_class_methods('C')
+    assert aim.PythonCode(code_str=code).get_class_string('B') == python_code.get_class_string('B')
+
+def test_PythonCode_nested(tmp_path):
+    path = tmp_path / 'nested.py'
+    path.write_text('class Outer:\n    class Inner:\n        def method(self):\n            pass\n')
+    python_code = aim.PythonCode(path)
+    methods = python_code.get_class_string('Inner', methods_flag=True)
+    assert methods['method'].strip() == 'def method(self):\n            pass'
+
+diff = '''diff --git a/pkg/core.py b/pkg/core.py
+index 1111111..2222222 100644
+--- a/pkg/core.py
++++ b/pkg/core.py
+@@ -1,3 +1,3 @@
+ class Sim:
+-    def run(self):
++    def run(self, n=1):   
+         return 1
+@@ -10,2 +10,2 @@ def make(x):
+-def make(x):
++def build(x):
+diff --git a/docs/conf.py b/docs/conf.py
+index 3333333..4444444 100644
+--- a/docs/conf.py
++++ b/docs/conf.py
+@@ -1 +1 @@
+-a = 1
++a = 2
+diff --git a/README.md b/README.md
+index 5555555..6666666 100644
+--- a/README.md
++++ b/README.md
+@@ -1 +1 @@
+-Old
++New
+'''
+
+def test_GitDiff(tmp_path):
+    git_diff = aim.GitDiff(diff)
+    assert [d['file'] for d in git_diff.diffs] == ['pkg/core.py']
+    hunks = git_diff.diffs[0]['hunks']
+    assert len(hunks) == 2
+    assert hunks[0].startswith('@@ -1,3 +1,3 @@\n')
+    assert '+    def run(self, n=1):\n' in hunks[0] # Trailing whitespace is removed
+    assert hunks[1] == '@@ -10,2 +10,2 @@ def make(x):\n-def make(x):\n+def build(x):\n'
+    assert git_diff.get_diff_string('pkg/core.py') == ''.join(hunks)
+
+    # Loading from a file or a list of lines gives the same result
+    path = tmp_path / 'diff.txt'
+    path.write_text(diff)
+    assert aim.GitDiff(path).diffs == git_diff.diffs
+    assert aim.GitDiff(diff.splitlines(keepends=True)).diffs == git_diff.diffs
+
+    # Include/exclude patterns
+    all_files = aim.GitDiff(diff, include_patterns=['*'], exclude_patterns=[])
+    assert [d['file'] for d in all_files.diffs] == ['pkg/core.py', 'docs/conf.py', 'README.md']
+    assert all_files.get_diff_string('README.md') == '@@ -1 +1 @@\n-Old\n+New\n'
+    all_files.diffs = all_files.diffs[1:] # The file index is rebuilt
+    assert all_files.get_diff_string('pkg/core.py') == ''
+
+def test_GitDiff_hunks():
+    hunk = '@@ -{0},1 +{0},1 @@\n-old{0}\n+new{0}\n'
+    hunks = [hunk.format(i) for i in range(1, 4)]
+    text = 'diff --git a/x.py b/x.py\n--- a/x.py\n+++ b/x.py\n' + ''.join(hunks)
+    git_diff = aim.GitDiff(text)
+    assert git_diff.diffs[0]['hunks'] == hunks
+
+def test_get_repository_files(tmp_path):
+    for file in ['a.py', 'b.txt', 'pkg/c.py', 'pkg/__init__.py', 'docs/d.py']:
+        path = tmp_path / file
+        path.parent.mkdir(exist_ok=True)
+        path.write_text('')
+    files = aim.get_python_files(tmp_path)
+    assert sorted(map(str, files)) == ['a.py', 'docs/d.py', 'pkg/__init__.py', 'pkg/c.py']
+    files = aim.get_python_files(tmp_path, include=['pkg/*', 'docs/*'], exclude=['docs/*', '*/__init__.py'])
+    assert list(map(str, files)) == ['pkg/c.py']
+
+def test_changed_names(tmp_path):
+    git_diff = aim.GitDiff(diff)
+    assert git_diff.get_changed_names() == {'run', 'make', 'build'}
+    path = tmp_path / 'code.py'
+    path.write_text('import pkg.core as pc\nsim = pc.Sim()\nsim.run(n=2)\n')
+    names = aim.PythonCode(path).get_names()
+    assert {'pkg', 'core', 'pc', 'sim', 'Sim', 'run', 'n'} <= names
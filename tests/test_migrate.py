@@ -0,0 +1,110 @@
+import subprocess
+import aimigrate as aim
+
+def make_code_files(folder):
+    code_files = []
+    for i, name in enumerate(['a.py', 'b.py', 'c.py']):
+        code_file = aim.CoreCodeFile(source=None, dest=folder / name, file=name, process=False)
+        code_file.orig_str = f'x = {i}\n'
+        code_file.make_prompt('Update this:\n```\n{code}\n```\n', prompt_kwargs={})
+        code_files.append(code_file)
+    return code_files
+
+def test_CoreCodeBatch(tmp_path):
+    code_files = make_code_files(tmp_path)
+    batch = aim.CoreCodeBatch(code_files)
+    assert '### FILE 1: a.py\nx = 0\n' in batch.prompt
+    assert '### FILE 3: c.py\nx = 2\n' in batch.prompt
+
+    prompts = []
+    def chatter(prompt):
+        prompts.append(prompt)
+        if prompt == batch.prompt: # Leave out b.py
+            return '### FILE 1: a.py\n```python\ny = 0\n```\n\n**### FILE 3: c.py**\n```python\ny = 2\n```\n'
+        return '```python\ny = 1\n```'
+    batch.run(chatter)
+    assert [code_file.new_str for code_file in code_files] == ['\ny = 0\n', '\ny = 1\n', '\ny = 2\n']
+    assert prompts == [batch.prompt, code_files[1].prompt] # Only the missing file is re-run
+    assert (tmp_path / 'c.py').read_text() == '\ny = 2\n'
+
+    # The default request for a single code block is replaced rather than contradicted
+    for code_file in code_files:
+        code_file.make_prompt(aim.migrate_oob.DEFAULT_BASE_PROMPT, prompt_kwargs=dict(library='ss', library_alias='', v_from='1', v_to='2'))
+    prompt = aim.CoreCodeBatch(code_files).prompt
+    assert 'single code block' not in prompt
+    assert prompt.rstrip().endswith('between three backticks (```).')
+
+def test_CoreCodeBatch_fallback_error(tmp_path):
+    code_files = make_code_files(tmp_path)
+    batch = aim.CoreCodeBatch(code_files)
+    migrator = aim.MigrateOOB(source_dir=tmp_path, dest_dir=tmp_path, library='mylib', verbose=False)
+
+    class Limiter:
+        calls = 0
+        def acquire(self, n_tokens=0):
+            Limiter.calls += 1
+    migrator.rate_limiter = Limiter()
+
+    def chatter(prompt):
+        if prompt == batch.prompt: # Leave out b.py, whose own query then fails
+            return '### FILE 1: a.py\n```python\ny = 0\n```\n### FILE 3: c.py\n```python\ny = 2\n```\n'
+        raise ConnectionError('Out of retries')
+    migrator.chatter = chatter
+    migrator.run_single(batch)
+    assert (tmp_path / 'a.py').read_text() == '\ny = 0\n'
+    assert (tmp_path / 'c.py').read_text() == '\ny = 2\n'
+    assert not (tmp_path / 'b.py').exists()
+    assert [code_file.error is None for code_file in code_files] == [True, False, True]
+    assert migrator.errors == [code_files[1].error]
+    assert Limiter.calls == 2 # The batch and the fallback query
+
+def test_duplicate_errors(tmp_path):
+    for name in ['a.py', 'b.py', 'c.py']:
+        (tmp_path / name).write_text('x = 1\n')
+    migrator = aim.MigrateOOB(source_dir=tmp_path, dest_dir=tmp_path / 'out', library='mylib', model='openai:fake-model', verbose=False)
+    def chatter(prompt):
+        raise ConnectionError('Out of retries')
+    migrator.chatter = chatter
+    migrator.run()
+    assert len(migrator.errors) == 3 # One query, but three files not migrated
+    assert all(code_file.error for code_file in migrator.code_files)
+
+def test_parse_response():
+    code_file = aim.CoreCodeFile(source=None, dest=None, file='a.py', process=False)
+    responses = {
+        'Here:\n```python\nx = 1\n```\nDone': '\nx = 1\n',
+        'Here:\n```py\nx = 1\n```': '\nx = 1\n',
+        'Here:\n```Python\nx = 1\n```': '\nx = 1\n',
+        'Here:\n```\nx = 1\n```': '\nx = 1\n',
+        'Here:\n```python\nx = 1\ny = ': '\nx = 1\ny = ', # Truncated
+        'x = 1\n': 'x = 1\n', # No code block
+    }
+    for response, expected in responses.items():
+        code_file.response = response
+        code_file.parse_response()
+        assert code_file.new_str == expected
+
+def git(*args, cwd):
+    subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@test', *args], cwd=cwd, check=True, capture_output=True)
+
+def test_MigrateDiff_subfolder(tmp_path):
+    repo = tmp_path / 'repo'
+    (repo / 'pkg' / 'sub').mkdir(parents=True)
+    files = {'pkg/sub/a.py': 'x = 1\n', 'pkg/b.py': 'y = 1\n', 'top.py': 'z = 1\n'}
+    for version in ['1', '2']:
+        for name, code in files.items():
+            (repo / name).write_text(code.replace('1', version))
+        if version == '1':
+            git('init', '-q', cwd=repo)
+        git('add', '.', cwd=repo)
+        git('commit', '-qm', f'v{version}', cwd=repo)
+        git('tag', f'v{version}', cwd=repo)
+    git('branch', 'v1', 'v1', cwd=repo) # An ambiguous name, which git warns about
+
+    def diff_files(**kwargs): # The library is a subfolder of the repo, but file names are from the top
+        migrator = aim.MigrateDiff(source_dir=tmp_path, dest_dir=tmp_path / 'out', library=repo / 'pkg', v_from='v1', v_to='v2', verbose=False, **kwargs)
+        migrator.make_diff()
+        return [diff['file'] for diff in migrator.git_diff.diffs]
+    assert diff_files() == ['pkg/b.py', 'pkg/sub/a.py', 'top.py']
+    assert diff_files(include=['pkg/sub/a.py']) == ['pkg/sub/a.py']
+    assert diff_files(exclude=['pkg/*']) == ['top.py']